@@ -6,6 +6,7 @@ FastAPI server yang melayani BGE-M3 embedding:
 - Dense vectors (1024d)
 - Sparse vectors (lexical weights)
 
+Deps: pip install FlagEmbedding fastapi uvicorn orjson (orjson wajib: default response class)
 Start: cd /path/to/FajarClaw && source .venv/bin/activate && python python/embedding_server.py
 """
 
@@ -17,14 +18,19 @@ from contextlib import asynccontextmanager
 
 import numpy as np
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 
+from lru import LRUCache
+
 # === Config ===
 
 MODEL_NAME = os.environ.get("EMBEDDING_MODEL", "BAAI/bge-m3")
 HOST = os.environ.get("EMBEDDING_HOST", "0.0.0.0")
 PORT = int(os.environ.get("EMBEDDING_PORT", "8100"))
 USE_GPU = os.environ.get("EMBEDDING_USE_GPU", "true").lower() == "true"
+# Max cached per-text embeddings; 0 disables the cache
+CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "8192"))
 
 # === Models (Pydantic) ===
 
@@ -33,10 +39,15 @@ class EmbedRequest(BaseModel):
     texts: list[str]
     return_sparse: bool = True
 
+class SparseVec(BaseModel):
+    """Sparse vector sebagai array paralel token_id + weight"""
+    indices: list[int]
+    values: list[float]
+
 class EmbedResult(BaseModel):
     """Hasil embedding per text"""
     dense: list[float]
-    sparse: Optional[dict[int, float]] = None
+    sparse: Optional[SparseVec] = None
 
 class EmbedResponse(BaseModel):
     """Response dari embedding endpoint"""
@@ -50,6 +61,13 @@ class HealthResponse(BaseModel):
     model: str
     device: str
     ready: bool
+    cache_size: int
+    cache_hit_rate: float
+
+# === Embedding Cache ===
+
+# (text, return_sparse) -> {"dense": ndarray, "sparse": {...} | None}
+_cache = LRUCache(CACHE_SIZE)
 
 # === Global Model ===
 
@@ -84,12 +102,29 @@ def load_model():
     logging.info(f"Model loaded in {elapsed:.1f}s on {_device}")
     return _model
 
+def to_sparse_vec(raw_sparse) -> dict:
+    """Convert BGE-M3 lexical weights to parallel (indices, values) arrays"""
+    if hasattr(raw_sparse, 'items'):
+        return {
+            "indices": [int(k) for k in raw_sparse.keys()],
+            "values": np.fromiter(raw_sparse.values(), dtype=np.float32, count=len(raw_sparse)),
+        }
+    if isinstance(raw_sparse, np.ndarray):
+        nonzero = np.nonzero(raw_sparse)[0]
+        return {
+            "indices": nonzero,
+            "values": raw_sparse[nonzero].astype(np.float32),
+        }
+    return {"indices": [], "values": []}
+
 # === FastAPI App ===
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Preload model on startup"""
-    load_model()
+    model = load_model()
+    # Warm up so the first real request skips kernel autotuning
+    model.encode(["warmup " * 120] * 8, return_dense=True, return_sparse=True, return_colbert_vecs=False)
     yield
 
 app = FastAPI(
@@ -97,6 +132,7 @@ app = FastAPI(
     description="BGE-M3 dense + sparse embeddings for RAG pipeline",
     version="1.0.0",
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 @app.get("/health", response_model=HealthResponse)
@@ -107,6 +143,8 @@ async def health():
         model=MODEL_NAME,
         device=_device,
         ready=_model is not None,
+        cache_size=len(_cache),
+        cache_hit_rate=_cache.hit_rate,
     )
 
 @app.post("/embed", response_model=EmbedResponse)
@@ -115,7 +153,9 @@ async def embed(request: EmbedRequest):
     Generate embeddings for input texts.
     Returns dense (1024d) and optionally sparse vectors.
     """
-    model = load_model()
+    model = _model
+    if model is None:
+        raise HTTPException(503, "model not loaded")
     
     if not request.texts:
         raise HTTPException(400, "texts cannot be empty")
@@ -125,41 +165,41 @@ async def embed(request: EmbedRequest):
     
     start = time.time()
     
-    try:
-        output = model.encode(
-            request.texts,
-            return_dense=True,
-            return_sparse=request.return_sparse,
-            return_colbert_vecs=False,
-        )
-    except Exception as e:
-        raise HTTPException(500, f"Encoding failed: {str(e)}")
+    # Serve repeated texts from cache; encode only the misses
+    keys = [(text, request.return_sparse) for text in request.texts]
+    results = [_cache.get(key) for key in keys]
+    missing = [i for i, r in enumerate(results) if r is None]
     
-    results = []
-    for i in range(len(request.texts)):
-        dense = output["dense_vecs"][i].tolist()
+    if missing:
+        try:
+            output = model.encode(
+                [request.texts[i] for i in missing],
+                return_dense=True,
+                return_sparse=request.return_sparse,
+                return_colbert_vecs=False,
+            )
+        except Exception as e:
+            raise HTTPException(500, f"Encoding failed: {str(e)}")
         
-        sparse = None
-        if request.return_sparse and "lexical_weights" in output:
-            raw_sparse = output["lexical_weights"][i]
-            # Convert to {token_id: weight} dict
-            if hasattr(raw_sparse, 'items'):
-                sparse = {int(k): float(v) for k, v in raw_sparse.items()}
-            elif isinstance(raw_sparse, np.ndarray):
-                nonzero = np.nonzero(raw_sparse)[0]
-                sparse = {int(idx): float(raw_sparse[idx]) for idx in nonzero}
-            else:
-                sparse = {}
-        
-        results.append(EmbedResult(dense=dense, sparse=sparse))
+        # Keep dense vectors as NumPy rows; orjson serializes them in C
+        dense_vecs = np.asarray(output["dense_vecs"], dtype=np.float32)
+        for j, i in enumerate(missing):
+            # Own the row: a view would keep the whole batch array alive in the cache
+            result = {"dense": dense_vecs[j].copy(), "sparse": None}
+            if request.return_sparse and "lexical_weights" in output:
+                result["sparse"] = to_sparse_vec(output["lexical_weights"][j])
+            results[i] = result
+            _cache.put(keys[i], result)
     
     duration = (time.time() - start) * 1000
     
-    return EmbedResponse(
-        results=results,
-        model=MODEL_NAME,
-        duration_ms=round(duration, 2),
-    )
+    # Returned directly to skip Pydantic validation of ~1k floats per text;
+    # the shape still matches EmbedResponse
+    return ORJSONResponse({
+        "results": results,
+        "model": MODEL_NAME,
+        "duration_ms": round(duration, 2),
+    })
 
 # === Entrypoint ===
 
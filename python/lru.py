@@ -0,0 +1,44 @@
+"""
+FajarClaw RAG — Shared LRU Cache
+@ref FC-PRD-01 §10.7 (Cross-Encoder Reranking), §10.3 (Embedding Pipeline)
+
+Size-bounded LRU map used by the model servers to skip repeated forwards.
+Evicts by entry count (not time) and tracks hits/misses for /health.
+"""
+
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Size-bounded LRU map with hit/miss counters. `maxsize <= 0` disables it."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return round(self.hits / total, 4) if total else 0.0
@@ -8,16 +8,24 @@ Accepts query + candidates, returns reranked results with scores.
 
 import os
 import time
+import heapq
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, nullcontext
+from hashlib import blake2b
 from typing import Optional
 
+# Curb CUDA allocator fragmentation under concurrent, variable-shape load
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
 import uvicorn
 from fastapi import FastAPI
 from pydantic import BaseModel, Field
 
-logging.basicConfig(level=logging.INFO)
+from lru import LRUCache
 
-app = FastAPI(title="FajarClaw Reranker", version="1.0.0")
+logging.basicConfig(level=logging.INFO)
 
 # === Config ===
 
@@ -25,51 +33,509 @@ MODEL_NAME = os.environ.get("RERANKER_MODEL", "Qwen/Qwen3-Reranker-0.6B")
 HOST = os.environ.get("RERANKER_HOST", "0.0.0.0")
 PORT = int(os.environ.get("RERANKER_PORT", "8101"))
 USE_GPU = os.environ.get("RERANKER_USE_GPU", "true").lower() == "true"
+# Uvicorn worker processes, each with its own model copy
+WORKERS = int(os.environ.get("RERANKER_WORKERS", "1"))
+# Per-process VRAM cap (0 = auto: split 90% of the GPU evenly across workers)
+GPU_MEMORY_FRACTION = float(os.environ.get("RERANKER_GPU_MEMORY_FRACTION", "0"))
+BATCH_SIZE = int(os.environ.get("RERANKER_BATCH_SIZE", "16"))
+# Two-stage cascade: a small cross-encoder prefilters, MODEL_NAME rescores the top survivors
+SMALL_MODEL_NAME = os.environ.get("RERANKER_SMALL_MODEL", "cross-encoder/ms-marco-TinyBERT-L-2-v2")
+USE_CASCADE = os.environ.get("RERANKER_CASCADE", "false").lower() == "true"
+CASCADE_TOP_K = int(os.environ.get("RERANKER_CASCADE_TOP_K", "20"))
+# Capture CUDA graphs for fixed (batch, seq) buckets (torch backend on GPU only)
+USE_CUDA_GRAPHS = os.environ.get("RERANKER_CUDA_GRAPHS", "false").lower() == "true"
+GRAPH_SEQ_LENS = (128, 256, 512)
+# torch.compile the torch backend (operator fusion; first requests per shape are slow)
+USE_COMPILE = os.environ.get("RERANKER_COMPILE", "false").lower() == "true"
+# "torch" (HF Transformers), "onnx" (ONNX Runtime via optimum) or "ipex" (CPU, optimum-intel)
+BACKEND = os.environ.get("RERANKER_BACKEND", "torch").lower()
+# Root for cached ONNX exports; each model gets its own subdirectory
+ONNX_DIR = os.environ.get(
+    "RERANKER_ONNX_DIR",
+    os.path.join(os.path.dirname(__file__), "..", "models", "reranker-onnx"),
+)
+# INC/IPEX INT8 checkpoint for the "ipex" backend (falls back to MODEL_NAME if absent)
+IPEX_DIR = os.environ.get(
+    "RERANKER_IPEX_DIR",
+    os.path.join(os.path.dirname(__file__), "..", "models", "reranker-ipex-int8"),
+)
+# bfloat16 autocast for the torch backend on CPU (needs AVX512-BF16/AMX to pay off)
+CPU_BF16 = os.environ.get("RERANKER_CPU_BF16", "false").lower() == "true"
+
+# Max cached (query, passage) scores; 0 disables the cache
+CACHE_SIZE = int(os.environ.get("RERANKER_CACHE_SIZE", "65536"))
+
+# === Score Cache ===
+
+def text_digest(text: str) -> bytes:
+    """Stable 16-byte key for cache lookups."""
+    return blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+score_cache = LRUCache(CACHE_SIZE)
 
 # === Model ===
 
 model = None
 tokenizer = None
+small_model = None
+small_tokenizer = None
 device = "cpu"
+backend = "torch"
+# Set only once load_model() has finished (buffers, graphs, cascade and warmup included)
+ready = False
+# Serializes lazy loads so concurrent first requests don't load the model twice
+load_lock = asyncio.Lock()
+# Loading, warmup and every forward run on this one thread: CUDA graphs (manual or
+# torch.compile "reduce-overhead") are recorded per thread and must be replayed there
+forward_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="reranker-forward")
+# (batch, seq) -> (graph, static_inputs, static_logits)
+cuda_graphs = {}
+# Reusable (BATCH_SIZE, 512) device buffers per model input name (torch on GPU)
+input_buffers = None
 
 
 def load_model():
     """Load reranker model (lazy, on first request or startup)."""
-    global model, tokenizer, device
+    global model, tokenizer, small_model, small_tokenizer, device, backend, input_buffers, ready
     import torch
-    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+    from transformers import (
+        AutoConfig,
+        AutoModelForSequenceClassification,
+        AutoTokenizer,
+        PreTrainedTokenizerFast,
+    )
 
     if USE_GPU and torch.cuda.is_available():
         device = "cuda"
+        torch.backends.cuda.enable_flash_sdp(True)
+        torch.backends.cuda.enable_mem_efficient_sdp(True)
     else:
         device = "cpu"
 
+    if WORKERS > 1:
+        if device == "cuda":
+            fraction = GPU_MEMORY_FRACTION or 0.9 / WORKERS
+            torch.cuda.set_per_process_memory_fraction(fraction)
+        else:
+            # Split CPU cores between workers instead of oversubscribing
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // WORKERS))
+    elif GPU_MEMORY_FRACTION and device == "cuda":
+        torch.cuda.set_per_process_memory_fraction(GPU_MEMORY_FRACTION)
+
     logging.info(f"Loading model: {MODEL_NAME} on {device}")
     start = time.time()
 
-    tokenizer = AutoTokenizer.from_pretrained(
-        MODEL_NAME,
-        trust_remote_code=True,
-        padding_side="left",
-    )
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, trust_remote_code=True, use_fast=True)
+    # Decoder-only rerankers (Qwen3) are left-padded so the last token lines up;
+    # other cross-encoders keep their tokenizer's configured side (right for BERT)
+    config = AutoConfig.from_pretrained(MODEL_NAME, trust_remote_code=True)
+    if config.model_type.startswith("qwen"):
+        tokenizer.padding_side = "left"
+    if not isinstance(tokenizer, PreTrainedTokenizerFast):
+        logging.warning(f"No fast (Rust) tokenizer for {MODEL_NAME}; batch tokenization will be slow")
     # Set pad_token if missing (required for batch inference)
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
         tokenizer.pad_token_id = tokenizer.eos_token_id
 
-    model = AutoModelForSequenceClassification.from_pretrained(
-        MODEL_NAME,
-        trust_remote_code=True,
-        dtype=torch.float16 if device == "cuda" else torch.float32,
-    )
+    model = None
+    backend = "torch"
+    if BACKEND == "onnx":
+        try:
+            model = load_onnx_model()
+            backend = "onnx"
+        except Exception as e:
+            logging.warning(f"ONNX backend unavailable ({e}), falling back to torch")
+    elif BACKEND == "ipex" and device == "cpu":
+        try:
+            model = load_ipex_model()
+            backend = "ipex"
+        except Exception as e:
+            logging.warning(f"IPEX backend unavailable ({e}), falling back to torch")
+
+    if model is None:
+        model = load_with_attention(
+            AutoModelForSequenceClassification,
+            MODEL_NAME,
+            attn_implementations(),
+            trust_remote_code=True,
+            dtype=model_dtype(),
+        )
+        model = model.to(device)
+        model.eval()
+        if USE_COMPILE and hasattr(torch, "compile"):
+            # Manual CUDA graphs and "reduce-overhead" would both capture graphs
+            mode = "default" if USE_CUDA_GRAPHS else "reduce-overhead"
+            model = torch.compile(model, mode=mode, dynamic=True)
+
     # Set pad_token_id on model config
     if model.config.pad_token_id is None:
         model.config.pad_token_id = tokenizer.pad_token_id
-    model = model.to(device)
-    model.eval()
+
+    if device == "cuda" and isinstance(model, torch.nn.Module):
+        input_buffers = {
+            name: torch.zeros((BATCH_SIZE, 512), dtype=torch.long, device=device)
+            for name in ("input_ids", "attention_mask", "token_type_ids")
+            if name in tokenizer.model_input_names
+        }
+        if USE_CUDA_GRAPHS:
+            capture_cuda_graphs()
+
+    if USE_CASCADE:
+        logging.info(f"Loading cascade prefilter: {SMALL_MODEL_NAME}")
+        small_tokenizer = AutoTokenizer.from_pretrained(SMALL_MODEL_NAME, use_fast=True)
+        # BERT has no FlashAttention-2 integration
+        small_model = load_with_attention(
+            AutoModelForSequenceClassification,
+            SMALL_MODEL_NAME,
+            ["sdpa", None],
+            dtype=model_dtype(),
+        )
+        small_model = small_model.to(device)
+        small_model.eval()
 
     elapsed = time.time() - start
-    logging.info(f"Model loaded in {elapsed:.1f}s on {device}")
+    logging.info(f"Model loaded in {elapsed:.1f}s on {device} ({backend})")
+
+    # Warm up with a dummy 8x128 batch so the first real request skips kernel autotuning
+    compute_scores("warmup", ["warmup " * 120] * 8)
+    if small_model is not None:
+        compute_scores("warmup", ["warmup " * 120] * 8, small=True)
+    ready = True
+
+
+def load_onnx_model():
+    """Load reranker as an ONNX Runtime session (exported once per model, cached under ONNX_DIR).
+
+    On CPU, prefers an INT8 `model_quantized.onnx` when present, e.g. produced by
+    `optimum-cli onnxruntime quantize --onnx_model <export dir> --avx512_vnni`.
+    """
+    import onnxruntime as ort
+    from optimum.onnxruntime import ORTModelForSequenceClassification
+    from transformers import AutoConfig
+
+    if device == "cuda":
+        provider = "CUDAExecutionProvider"
+        provider_options = {"cudnn_conv_algo_search": "HEURISTIC"}
+    else:
+        provider = "CPUExecutionProvider"
+        provider_options = None
+
+    session_options = ort.SessionOptions()
+    session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    export_dir = os.path.join(ONNX_DIR, MODEL_NAME.replace("/", "--"))
+    if os.path.isfile(os.path.join(export_dir, "model.onnx")):
+        file_name = "model.onnx"
+        # INT8 dynamic quantization targets CPU kernels (VNNI), not the CUDA EP
+        quantized = os.path.isfile(os.path.join(export_dir, "model_quantized.onnx"))
+        if quantized and provider == "CPUExecutionProvider":
+            file_name = "model_quantized.onnx"
+        logging.info(f"Loading ONNX reranker: {export_dir}/{file_name} ({provider})")
+        return ORTModelForSequenceClassification.from_pretrained(
+            export_dir,
+            file_name=file_name,
+            provider=provider,
+            provider_options=provider_options,
+            session_options=session_options,
+        )
+
+    # Export with pad_token_id set, otherwise seq-cls export fails on batch > 1
+    config = AutoConfig.from_pretrained(MODEL_NAME, trust_remote_code=True)
+    if config.pad_token_id is None:
+        config.pad_token_id = tokenizer.pad_token_id
+
+    logging.info(f"Exporting {MODEL_NAME} to ONNX ({export_dir})")
+    onnx_model = ORTModelForSequenceClassification.from_pretrained(
+        MODEL_NAME,
+        config=config,
+        export=True,
+        trust_remote_code=True,
+        provider=provider,
+        provider_options=provider_options,
+        session_options=session_options,
+    )
+    onnx_model.save_pretrained(export_dir)
+    return onnx_model
+
+
+def load_ipex_model():
+    """Load reranker through optimum-intel IPEX (CPU only).
+
+    Uses the INT8 checkpoint in IPEX_DIR when present (e.g. an INC static-quant
+    export), otherwise optimizes MODEL_NAME on the fly.
+    """
+    from optimum.intel import IPEXModelForSequenceClassification
+
+    path = IPEX_DIR if os.path.isdir(IPEX_DIR) else MODEL_NAME
+    logging.info(f"Loading IPEX reranker: {path}")
+    return IPEXModelForSequenceClassification.from_pretrained(path, trust_remote_code=True)
+
+
+def model_dtype():
+    """Weight dtype: bfloat16 on Ampere+ GPUs (fp32 exponent range, no fp16 softmax
+    overflow), float16 on older GPUs, float32 on CPU."""
+    import torch
+
+    if device != "cuda":
+        return torch.float32
+    if torch.cuda.get_device_capability()[0] >= 8:
+        return torch.bfloat16
+    return torch.float16
+
+
+def attn_implementations() -> list:
+    """Fused attention kernels to try, best first; None leaves the choice to transformers.
+
+    FlashAttention-2 needs the flash_attn package and an Ampere+ GPU. With CUDA
+    graphs on, only eager attention is used: the SDPA/FA2 mask helpers branch on
+    the mask contents on the host (`.all()`, `nonzero`, `.item()`), which either
+    aborts capture or bakes the no-padding branch into the graph.
+    """
+    import torch
+
+    if USE_CUDA_GRAPHS and device == "cuda":
+        return ["eager"]
+    candidates = []
+    if device == "cuda" and torch.cuda.get_device_capability()[0] >= 8:
+        try:
+            import flash_attn  # noqa: F401
+            candidates.append("flash_attention_2")
+        except ImportError:
+            pass
+    return candidates + ["sdpa", None]
+
+
+def load_with_attention(loader, name: str, candidates: list, **kwargs):
+    """Call `loader.from_pretrained`, falling back through `candidates` when a
+    model class rejects an attention implementation."""
+    for attn in candidates:
+        try:
+            if attn is None:
+                return loader.from_pretrained(name, **kwargs)
+            return loader.from_pretrained(name, attn_implementation=attn, **kwargs)
+        except (ValueError, ImportError) as e:
+            if attn is None:
+                raise
+            logging.warning(f"{name}: attn_implementation={attn} unavailable ({e}), trying next")
+
+
+def autocast_context(cache_enabled: bool = True):
+    """Mixed-precision context for the plain torch backend.
+
+    Pass `cache_enabled=False` around CUDA graph capture, where cached weight
+    casts must not outlive the capture.
+    """
+    import torch
+
+    if backend == "torch" and device == "cuda":
+        return torch.autocast("cuda", dtype=model_dtype(), cache_enabled=cache_enabled)
+    if backend == "torch" and device == "cpu" and CPU_BF16:
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return nullcontext()
+
+
+def capture_cuda_graphs():
+    """Capture one CUDA graph per (batch, seq) bucket to skip per-kernel launch cost."""
+    import torch
+
+    cuda_graphs.clear()
+    batch_sizes = sorted({1, min(8, BATCH_SIZE), BATCH_SIZE})
+    start = time.time()
+    try:
+        for batch in batch_sizes:
+            for seq_len in GRAPH_SEQ_LENS:
+                static_inputs = {
+                    "input_ids": torch.full(
+                        (batch, seq_len), tokenizer.pad_token_id, dtype=torch.long, device=device
+                    ),
+                    "attention_mask": torch.ones((batch, seq_len), dtype=torch.long, device=device),
+                }
+                # Capture with real padding so nothing specializes on an all-ones mask
+                half = seq_len // 2
+                pad_cols = slice(0, half) if tokenizer.padding_side == "left" else slice(half, None)
+                static_inputs["attention_mask"][:, pad_cols] = 0
+                if "token_type_ids" in tokenizer.model_input_names:
+                    static_inputs["token_type_ids"] = torch.zeros(
+                        (batch, seq_len), dtype=torch.long, device=device
+                    )
+
+                # Warm up on a side stream before capture (required by torch.cuda.graph)
+                stream = torch.cuda.Stream()
+                stream.wait_stream(torch.cuda.current_stream())
+                with torch.no_grad(), autocast_context(cache_enabled=False), torch.cuda.stream(stream):
+                    for _ in range(3):
+                        model(**static_inputs)
+                torch.cuda.current_stream().wait_stream(stream)
+
+                graph = torch.cuda.CUDAGraph()
+                with torch.no_grad(), autocast_context(cache_enabled=False), torch.cuda.graph(graph):
+                    static_logits = model(**static_inputs).logits
+                cuda_graphs[(batch, seq_len)] = (graph, static_inputs, static_logits)
+        verify_cuda_graphs()
+    except Exception as e:
+        logging.warning(f"CUDA graph capture failed ({e}), using eager forward")
+        cuda_graphs.clear()
+        return
+
+    elapsed = time.time() - start
+    logging.info(f"Captured {len(cuda_graphs)} CUDA graphs in {elapsed:.1f}s")
+
+
+def verify_cuda_graphs():
+    """Check every captured graph against the eager forward on a padded batch.
+
+    Raises RuntimeError on a mismatch so the caller falls back to eager.
+    """
+    import torch
+
+    for bucket in sorted(cuda_graphs):
+        batch, seq_len = bucket
+        # Passages of different lengths so the batch is genuinely padded
+        texts = ["graph check " * (i + 1) for i in range(batch)]
+        encoded = encode_pairs(tokenizer, "graph check", texts)
+        inputs = tokenizer.pad(encoded, padding=True, return_tensors="pt")
+        if inputs["input_ids"].shape[1] > seq_len:
+            continue
+        with torch.no_grad(), autocast_context():
+            eager = model(**inputs.to(device)).logits.float()
+            replayed = replay_cuda_graph(bucket, inputs).float()
+        if not torch.allclose(replayed, eager, rtol=1e-2, atol=5e-2):
+            diff = (replayed - eager).abs().max().item()
+            raise RuntimeError(f"replay of bucket {bucket} differs from eager (max abs diff {diff:.4f})")
+
+
+def forward_logits(inputs):
+    """Run the reranker forward on padded host tensors (input_ids, attention_mask
+    and, for BERT-style models, token_type_ids).
+
+    Replays a captured CUDA graph when one fits, otherwise copies into the
+    preallocated device buffers (or moves to device) and runs eagerly.
+    """
+    batch, seq_len = inputs["input_ids"].shape
+    bucket = min(
+        (key for key in cuda_graphs if key[0] >= batch and key[1] >= seq_len),
+        default=None,
+    )
+    if bucket is None:
+        if input_buffers is None:
+            return model(**{name: t.to(device) for name, t in inputs.items()}).logits
+        views = {}
+        for name, tensor in inputs.items():
+            views[name] = input_buffers[name][:batch, :seq_len]
+            views[name].copy_(tensor, non_blocking=True)
+        return model(**views).logits
+    return replay_cuda_graph(bucket, inputs)
+
+
+def replay_cuda_graph(bucket: tuple[int, int], inputs):
+    """Copy padded host tensors into a captured graph's static inputs and replay it."""
+    batch, seq_len = inputs["input_ids"].shape
+    graph, static_inputs, static_logits = cuda_graphs[bucket]
+    # Extend padding to the bucket length on the tokenizer's padding side;
+    # spare rows are all-pad dummies
+    static_inputs["input_ids"].fill_(tokenizer.pad_token_id)
+    static_inputs["attention_mask"].zero_()
+    static_inputs["attention_mask"][batch:].fill_(1)
+    if "token_type_ids" in static_inputs:
+        static_inputs["token_type_ids"].zero_()
+    cols = slice(-seq_len, None) if tokenizer.padding_side == "left" else slice(0, seq_len)
+    for name, tensor in inputs.items():
+        static_inputs[name][:batch, cols].copy_(tensor)
+    graph.replay()
+    return static_logits[:batch]
+
+
+def score_column(config) -> int:
+    """Logit column holding the relevance score.
+
+    Single-logit cross-encoders (ms-marco MiniLM/TinyBERT) use column 0,
+    two-logit (irrelevant, relevant) heads use column 1. Qwen3 rerankers keep
+    column 0.
+    """
+    if config.num_labels == 2 and not config.model_type.startswith("qwen"):
+        return 1
+    return 0
+
+
+def query_prefix(model_name: str) -> str:
+    """Instruction prefix expected by Qwen3-Reranker; plain cross-encoders take the bare query."""
+    if "qwen3-reranker" in model_name.lower():
+        return "Instruct: Given a web search query, retrieve relevant passages that answer the query\nQuery: "
+    return ""
+
+
+def encode_pairs(tok, query: str, texts: list[str]) -> dict[str, list[list[int]]]:
+    """Tokenize (query, text) pairs, encoding the shared query only once.
+
+    The query is capped at 256 tokens; each passage is truncated to the
+    remaining budget of the 512-token window.
+    """
+    q_ids = tok(query, add_special_tokens=False, truncation=True, max_length=256)["input_ids"]
+    budget = 512 - len(q_ids) - tok.num_special_tokens_to_add(pair=True)
+    doc_ids = tok(texts, add_special_tokens=False, truncation=True, max_length=budget)["input_ids"]
+
+    encoded = {"input_ids": [], "attention_mask": []}
+    with_types = "token_type_ids" in tok.model_input_names
+    if with_types:
+        encoded["token_type_ids"] = []
+    for d_ids in doc_ids:
+        ids = tok.build_inputs_with_special_tokens(q_ids, d_ids)
+        encoded["input_ids"].append(ids)
+        encoded["attention_mask"].append([1] * len(ids))
+        if with_types:
+            encoded["token_type_ids"].append(tok.create_token_type_ids_from_sequences(q_ids, d_ids))
+    return encoded
+
+
+def score_pairs(query: str, texts: list[str], small: bool = False) -> list[float]:
+    """Score `query` against each passage, reusing cached scores where possible."""
+    query_key = text_digest(query)
+    keys = [(small, query_key, text_digest(text)) for text in texts]
+    scores = [score_cache.get(key) for key in keys]
+
+    missing = [i for i, score in enumerate(scores) if score is None]
+    if missing:
+        fresh = compute_scores(query, [texts[i] for i in missing], small=small)
+        for i, score in zip(missing, fresh):
+            scores[i] = score
+            score_cache.put(keys[i], score)
+    return scores
+
+
+def compute_scores(query: str, texts: list[str], small: bool = False) -> list[float]:
+    """Score `query` against each passage in length-sorted mini-batches.
+
+    Sorting by token length before batching means each mini-batch only pads
+    to its own longest pair instead of the longest pair in the request.
+    `small=True` scores with the cascade prefilter model instead.
+    """
+    import torch
+
+    tok = small_tokenizer if small else tokenizer
+    column = score_column((small_model if small else model).config)
+
+    encoded = encode_pairs(tok, query, texts)
+    ids = encoded["input_ids"]
+    order = sorted(range(len(texts)), key=lambda i: len(ids[i]))
+
+    scores = [0.0] * len(texts)
+    with torch.no_grad(), autocast_context():
+        for start in range(0, len(order), BATCH_SIZE):
+            batch_idx = order[start:start + BATCH_SIZE]
+            inputs = tok.pad(
+                {key: [rows[i] for i in batch_idx] for key, rows in encoded.items()},
+                padding=True,
+                return_tensors="pt",
+            )
+            if small:
+                logits = small_model(**inputs.to(device)).logits
+            else:
+                logits = forward_logits(inputs)
+            for i, score in zip(batch_idx, logits[:, column].float().cpu().tolist()):
+                scores[i] = score
+    return scores
 
 
 # === Request/Response ===
@@ -106,51 +572,61 @@ class HealthResponse(BaseModel):
     model: str
     device: str
     status: str
+    cache_size: int
+    cache_hit_rate: float
+
+
+# === App ===
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load model on startup."""
+    logging.info(f"Starting reranker server on {HOST}:{PORT}")
+    logging.info(f"Model: {MODEL_NAME}, GPU: {USE_GPU}")
+    await asyncio.get_running_loop().run_in_executor(forward_executor, load_model)
+    yield
+    forward_executor.shutdown(wait=False)
+
+
+app = FastAPI(title="FajarClaw Reranker", version="1.0.0", lifespan=lifespan)
 
 
 # === Endpoints ===
 
+def score_request(req: RerankRequest) -> tuple[list[int], list[float]]:
+    """Score a rerank request; returns (candidate indices, scores) for the rescored set."""
+    # Cascade: prefilter with the small model, rescore only the survivors
+    indices = list(range(len(req.candidates)))
+    keep = max(CASCADE_TOP_K, req.top_k)
+    if small_model is not None and len(indices) > keep:
+        small_scores = score_pairs(req.query, [c.text for c in req.candidates], small=True)
+        indices = heapq.nlargest(keep, indices, key=lambda i: small_scores[i])
+
+    # Format query for cross-encoder
+    query = query_prefix(MODEL_NAME) + req.query
+    scores = score_pairs(query, [req.candidates[idx].text for idx in indices])
+    return indices, scores
+
+
 @app.post("/rerank", response_model=RerankResponse)
 async def rerank(req: RerankRequest):
     """Rerank candidates using cross-encoder scoring."""
-    import torch
-
-    if model is None:
-        load_model()
+    loop = asyncio.get_running_loop()
+    if not ready:
+        # Load off the event loop so /health stays responsive; the lock makes
+        # concurrent first requests wait for one load instead of starting their own
+        async with load_lock:
+            if not ready:
+                await loop.run_in_executor(forward_executor, load_model)
 
     start = time.time()
+    indices, scores = await loop.run_in_executor(forward_executor, score_request, req)
 
-    # Format pairs for cross-encoder
-    prefix = "Instruct: Given a web search query, retrieve relevant passages that answer the query\nQuery: "
-    pairs = []
-    for candidate in req.candidates:
-        pairs.append([prefix + req.query, candidate.text])
-
-    # Score each pair individually to avoid batch padding issues
-    scores = []
-    with torch.no_grad():
-        for pair in pairs:
-            inputs = tokenizer(
-                [pair],
-                padding=True,
-                truncation=True,
-                max_length=512,
-                return_tensors="pt",
-            ).to(device)
-            outputs = model(**inputs)
-            logits = outputs.logits
-            logging.debug(f"Logits shape: {logits.shape}, values: {logits}")
-            # Flatten and take first value as relevance score
-            flat = logits.flatten().cpu().float()
-            score_val = flat[0].item()
-            scores.append(score_val)
-
-    # Build ranked results
-    indexed_scores = [(i, s) for i, s in enumerate(scores)]
-    indexed_scores.sort(key=lambda x: x[1], reverse=True)
+    # Build ranked results (partial top-k, O(N log k))
+    top_scores = heapq.nlargest(req.top_k, zip(indices, scores), key=lambda x: x[1])
 
     ranked = []
-    for rank, (idx, score) in enumerate(indexed_scores[:req.top_k]):
+    for idx, score in top_scores:
         candidate = req.candidates[idx]
         ranked.append(RankedResult(
             text=candidate.text,
@@ -173,28 +649,21 @@ async def rerank(req: RerankRequest):
 @app.get("/health", response_model=HealthResponse)
 async def health():
     """Health check endpoint."""
-    ready = model is not None
     return HealthResponse(
         ready=ready,
         model=MODEL_NAME,
         device=device,
         status="ready" if ready else "model_not_loaded",
+        cache_size=len(score_cache),
+        cache_hit_rate=score_cache.hit_rate,
     )
 
 
-@app.on_event("startup")
-async def startup():
-    """Load model on startup."""
-    logging.info(f"Starting reranker server on {HOST}:{PORT}")
-    logging.info(f"Model: {MODEL_NAME}, GPU: {USE_GPU}")
-    load_model()
-
-
 if __name__ == "__main__":
     uvicorn.run(
         "reranker_server:app",
         host=HOST,
         port=PORT,
-        workers=1,
+        workers=WORKERS,
         log_level="info",
     )
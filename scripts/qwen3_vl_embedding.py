@@ -1 +0,0 @@
-404: Not Found
\ No newline at end of file
@@ -6,6 +6,8 @@ FajarClaw Visual Embedding Server
 Serves Qwen3-VL-Embedding-2B for real image/text → 2048-dim vector.
 Uses AutoProcessor + AutoModel with patched transformers.
 
+Requires: transformers torch accelerate fastapi uvicorn orjson
+
 Usage:
     cd /home/primecore/Documents/FajarClaw
     source .venv/bin/activate
@@ -13,24 +15,56 @@ Usage:
 """
 
 import argparse
+import asyncio
 import base64
 import io
 import os
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
+
+# Curb CUDA allocator fragmentation under concurrent, variable-shape load (set before torch import)
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
 
+import numpy as np
 import torch
 import uvicorn
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from PIL import Image
 
-app = FastAPI(title="FajarClaw Visual Embedding Server", version="2.0.0")
+# Shared helpers live next to the other model servers in python/
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "python"))
+from lru import LRUCache  # noqa: E402
 
 # Global state
 processor = None
 model = None
 device = None
 EMBED_DIM = 2048
+# Pinned host buffer for GPU → CPU embedding copies (CUDA only)
+pinned_out = None
+
+# Fixed prompt paired with images on /embed-image
+IMAGE_PROMPT = "Describe this screenshot."
+
+# Dynamic batching: coalesce concurrent requests into one forward pass
+MAX_BATCH = int(os.environ.get("VISUAL_MAX_BATCH", "32"))
+MAX_WAIT_MS = float(os.environ.get("VISUAL_MAX_WAIT_MS", "5"))
+batch_queue: asyncio.Queue | None = None
+# All forwards run on one dedicated thread: torch.compile's "reduce-overhead"
+# CUDA graphs are per-thread, and the default pool is shared with image decoding
+forward_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="visual-forward")
+
+# Max cached /embed-text vectors; 0 disables the cache
+TEXT_CACHE_SIZE = int(os.environ.get("VISUAL_TEXT_CACHE_SIZE", "1024"))
+text_cache = LRUCache(TEXT_CACHE_SIZE)
+
+# torch.compile the encoder (operator fusion; first requests per shape are slow)
+USE_COMPILE = os.environ.get("VISUAL_COMPILE", "false").lower() == "true"
 
 MODEL_PATH = os.environ.get(
     "VISUAL_MODEL_PATH",
@@ -60,39 +94,201 @@ class EmbedResponse(BaseModel):
 
 
 def load_model():
-    global processor, model, device
+    global processor, model, device, pinned_out
 
     print(f"[VISUAL] Loading model from {MODEL_PATH}...")
     start = time.time()
     device = "cuda" if torch.cuda.is_available() else "cpu"
 
-    from transformers import AutoProcessor, AutoModel
+    from transformers import AutoProcessor, AutoModel, PreTrainedTokenizerFast
 
+    # No use_fast here: AutoProcessor forwards it to the image processor as well, and the
+    # torchvision fast image processor yields different pixel_values than the indexed vectors.
+    # AutoTokenizer already defaults to the fast tokenizer.
     processor = AutoProcessor.from_pretrained(MODEL_PATH, trust_remote_code=True)
-    model = AutoModel.from_pretrained(
-        MODEL_PATH, trust_remote_code=True, dtype=torch.float16
-    ).to(device).eval()
+    if not isinstance(processor.tokenizer, PreTrainedTokenizerFast):
+        print("[VISUAL] ⚠️ No fast (Rust) tokenizer available; batch tokenization will be slow")
+    # Right-pad batches so real tokens keep the same positions as unbatched input
+    processor.tokenizer.padding_side = "right"
+    # bfloat16 on Ampere+ avoids fp16 overflow in attention softmax
+    if device == "cuda" and torch.cuda.get_device_capability()[0] >= 8:
+        dtype = torch.bfloat16
+    else:
+        dtype = torch.float16
+    # Fused attention: FlashAttention-2 (Ampere+, when installed), then SDPA,
+    # then whatever the remote model class supports by default
+    candidates = ["sdpa", None]
+    if device == "cuda":
+        torch.backends.cuda.enable_flash_sdp(True)
+        torch.backends.cuda.enable_mem_efficient_sdp(True)
+        if torch.cuda.get_device_capability()[0] >= 8:
+            try:
+                import flash_attn  # noqa: F401
+                candidates.insert(0, "flash_attention_2")
+            except ImportError:
+                pass
+    for attn in candidates:
+        kwargs = {"attn_implementation": attn} if attn else {}
+        try:
+            model = AutoModel.from_pretrained(
+                MODEL_PATH, trust_remote_code=True, dtype=dtype, **kwargs
+            )
+            break
+        except (ValueError, ImportError) as e:
+            if attn is None:
+                raise
+            print(f"[VISUAL] ⚠️ attn_implementation={attn} unavailable ({e}), trying next")
+    model = model.to(device).eval()
+    if USE_COMPILE and hasattr(torch, "compile"):
+        model = torch.compile(model, mode="reduce-overhead", dynamic=True)
+
+    if device == "cuda":
+        pinned_out = torch.empty((MAX_BATCH, EMBED_DIM), dtype=torch.float32, pin_memory=True)
 
     elapsed = time.time() - start
     vram = torch.cuda.memory_allocated() / 1024**3 if device == "cuda" else 0
     print(f"[VISUAL] ✅ Model loaded in {elapsed:.1f}s | dim={EMBED_DIM} | VRAM={vram:.1f}GB")
 
 
-def get_embedding(inputs) -> list[float]:
-    """Forward pass → normalized embedding."""
-    with torch.no_grad():
+def embed_batch(texts: list[str], images: list) -> np.ndarray:
+    """Forward pass over a batch → masked mean-pooled, normalized embeddings."""
+    batch_images = [img for img in images if img is not None]
+    inputs = processor(
+        text=texts, images=batch_images or None, return_tensors="pt", padding=True
+    )
+    inputs = {k: v.to(device) for k, v in inputs.items()}
+    with torch.no_grad(), torch.autocast(device, dtype=model.dtype, enabled=device == "cuda"):
         out = model(**inputs)
-        emb = out.last_hidden_state.mean(dim=1)
+        mask = inputs["attention_mask"].unsqueeze(-1).to(out.last_hidden_state.dtype)
+        emb = (out.last_hidden_state * mask).sum(dim=1) / mask.sum(dim=1)
         emb = torch.nn.functional.normalize(emb, p=2, dim=-1)
-    return emb[0].cpu().float().tolist()
+
+    if pinned_out is None:
+        return emb.float().cpu().numpy()
+    host = pinned_out[:len(texts)]
+    host.copy_(emb.float(), non_blocking=True)
+    torch.cuda.current_stream().synchronize()
+    # Copy out of the shared buffer before the next batch overwrites it
+    return host.numpy().copy()
+
+
+async def run_batch(items: list) -> None:
+    """Embed queued (prompt, image, future) items together and resolve their futures.
+
+    If a multi-item batch fails, the items are retried one by one so only the
+    offending request (e.g. an image the processor rejects) gets the error.
+    """
+    loop = asyncio.get_running_loop()
+    texts = [text for text, _, _ in items]
+    images = [img for _, img, _ in items]
+    try:
+        vectors = await loop.run_in_executor(forward_executor, embed_batch, texts, images)
+    except Exception as e:
+        if len(items) == 1:
+            _, _, future = items[0]
+            if not future.done():
+                future.set_exception(e)
+            return
+        for item in items:
+            await run_batch([item])
+        return
+
+    for (_, _, future), vec in zip(items, vectors):
+        if not future.done():
+            future.set_result(vec)
+
+
+async def batch_worker():
+    """Drain up to MAX_BATCH queued requests (or wait MAX_WAIT_MS) and embed them together."""
+    loop = asyncio.get_running_loop()
+    while True:
+        items = [await batch_queue.get()]
+        # Sole queue consumer: never let an error escape and kill the loop
+        try:
+            deadline = loop.time() + MAX_WAIT_MS / 1000
+            while len(items) < MAX_BATCH:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(batch_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await run_batch(items)
+        except Exception as e:
+            for _, _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+
+
+async def get_embedding(text_input: str, image=None) -> np.ndarray:
+    """Queue one prompt (+ optional image) for the batch worker and await its vector."""
+    future = asyncio.get_running_loop().create_future()
+    await batch_queue.put((text_input, image, future))
+    return await future
+
+
+@lru_cache(maxsize=1024)
+def render_prompt(text: str, with_image: bool = False) -> str:
+    """Render the chat template once per distinct prompt.
+
+    The template only emits an image placeholder (expanded later by the
+    processor), so the rendered string does not depend on the image itself.
+    """
+    content = [{"type": "image"}] if with_image else []
+    content.append({"type": "text", "text": text})
+    messages = [{"role": "user", "content": content}]
+    return processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+
+
+def embed_response(vec: np.ndarray, start: float) -> ORJSONResponse:
+    """EmbedResponse-shaped JSON; orjson serializes the NumPy vector without a Python list."""
+    return ORJSONResponse({
+        "vector": vec,
+        "dimension": len(vec),
+        "duration_ms": round((time.time() - start) * 1000, 1),
+    })
 
 
 def decode_b64_image(image_b64: str) -> Image.Image:
     try:
-        return Image.open(io.BytesIO(base64.b64decode(image_b64))).convert("RGB")
+        img = Image.open(io.BytesIO(base64.b64decode(image_b64))).convert("RGB")
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
 
+    # Downscale to the processor's pixel budget up front so it copies less data
+    max_pixels = getattr(processor.image_processor, "max_pixels", None)
+    if max_pixels and img.width * img.height > max_pixels:
+        scale = (max_pixels / (img.width * img.height)) ** 0.5
+        size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        img = img.resize(size, Image.BICUBIC)
+    return img
+
+
+async def decode_image(image_b64: str) -> Image.Image:
+    """Decode on a worker thread so large images don't block the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(None, decode_b64_image, image_b64)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start the dynamic batching worker."""
+    global batch_queue
+    batch_queue = asyncio.Queue()
+    worker = asyncio.create_task(batch_worker())
+    yield
+    worker.cancel()
+    forward_executor.shutdown(wait=False)
+
+
+app = FastAPI(
+    title="FajarClaw Visual Embedding Server",
+    version="2.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+
 
 @app.get("/health")
 def health():
@@ -105,63 +301,53 @@ def health():
         "gpu": device == "cuda",
         "dimension": EMBED_DIM,
         "vram_gb": round(vram, 2),
+        "text_cache_size": len(text_cache),
+        "text_cache_hit_rate": text_cache.hit_rate,
     }
 
 
 @app.post("/embed-image", response_model=EmbedResponse)
-def embed_image_endpoint(req: EmbedImageRequest):
+async def embed_image_endpoint(req: EmbedImageRequest):
     """Embed image → 2048-dim vector (REAL visual pipeline)."""
     if model is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
     start = time.time()
 
-    img = decode_b64_image(req.image)
-    messages = [{"role": "user", "content": [
-        {"type": "image", "image": img},
-        {"type": "text", "text": "Describe this screenshot."},
-    ]}]
-    text_input = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    inputs = processor(text=text_input, images=[img], return_tensors="pt", padding=True)
-    inputs = {k: v.to(device) for k, v in inputs.items()}
+    img = await decode_image(req.image)
+    text_input = render_prompt(IMAGE_PROMPT, with_image=True)
 
-    vec = get_embedding(inputs)
-    return EmbedResponse(vector=vec, dimension=len(vec), duration_ms=round((time.time() - start) * 1000, 1))
+    vec = await get_embedding(text_input, img)
+    return embed_response(vec, start)
 
 
 @app.post("/embed-cross-modal", response_model=EmbedResponse)
-def embed_cross_modal_endpoint(req: EmbedCrossModalRequest):
+async def embed_cross_modal_endpoint(req: EmbedCrossModalRequest):
     """Embed image + text → 2048-dim vector."""
     if model is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
     start = time.time()
 
-    img = decode_b64_image(req.image)
-    messages = [{"role": "user", "content": [
-        {"type": "image", "image": img},
-        {"type": "text", "text": req.text},
-    ]}]
-    text_input = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    inputs = processor(text=text_input, images=[img], return_tensors="pt", padding=True)
-    inputs = {k: v.to(device) for k, v in inputs.items()}
+    img = await decode_image(req.image)
+    text_input = render_prompt(req.text, with_image=True)
 
-    vec = get_embedding(inputs)
-    return EmbedResponse(vector=vec, dimension=len(vec), duration_ms=round((time.time() - start) * 1000, 1))
+    vec = await get_embedding(text_input, img)
+    return embed_response(vec, start)
 
 
 @app.post("/embed-text", response_model=EmbedResponse)
-def embed_text_endpoint(req: EmbedTextRequest):
+async def embed_text_endpoint(req: EmbedTextRequest):
     """Embed text for visual search → 2048-dim vector."""
     if model is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
     start = time.time()
 
-    messages = [{"role": "user", "content": [{"type": "text", "text": req.text}]}]
-    text_input = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    inputs = processor(text=text_input, return_tensors="pt", padding=True)
-    inputs = {k: v.to(device) for k, v in inputs.items()}
-
-    vec = get_embedding(inputs)
-    return EmbedResponse(vector=vec, dimension=len(vec), duration_ms=round((time.time() - start) * 1000, 1))
+    vec = text_cache.get(req.text)
+    if vec is None:
+        text_input = render_prompt(req.text)
+        vec = await get_embedding(text_input)
+        # get_embedding hands back a row of the batch result; cache an owned copy
+        text_cache.put(req.text, vec.copy())
+    return embed_response(vec, start)
 
 
 if __name__ == "__main__":
@@ -6,7 +6,7 @@
  *   Start: cd FajarClaw && source .venv/bin/activate && python python/embedding_server.py
  */
 
-import { describe, it, expect, beforeAll } from 'vitest';
+import { describe, it, expect, beforeAll, afterEach, vi } from 'vitest';
 import { Socket } from 'node:net';
 import {
     embed,
@@ -67,6 +67,41 @@ describe('Embedder — Unit Tests', () => {
     });
 });
 
+describe('Embedder — Sparse Decoding (mocked fetch)', () => {
+    afterEach(() => {
+        vi.unstubAllGlobals();
+    });
+
+    function mockEmbedResponse(results: unknown[]): void {
+        vi.stubGlobal('fetch', vi.fn(async () => new Response(
+            JSON.stringify({ results, model: 'BAAI/bge-m3', duration_ms: 1.5 }),
+            { status: 200, headers: { 'Content-Type': 'application/json' } },
+        )));
+    }
+
+    it('harus decode {indices, values} ke Record<number, number>', async () => {
+        mockEmbedResponse([
+            { dense: [0.1, 0.2], sparse: { indices: [42, 100, 256], values: [0.8, 0.5, 0.3] } },
+        ]);
+        const result = await embed({ texts: ['hello'] });
+        expect(result.results[0]!.sparse).toEqual({ 42: 0.8, 100: 0.5, 256: 0.3 });
+        expect(result.results[0]!.dense).toEqual([0.1, 0.2]);
+        expect(result.durationMs).toBe(1.5);
+    });
+
+    it('harus decode sparse kosong ke object kosong', async () => {
+        mockEmbedResponse([{ dense: [0.1], sparse: { indices: [], values: [] } }]);
+        const result = await embed({ texts: ['hello'] });
+        expect(result.results[0]!.sparse).toEqual({});
+    });
+
+    it('harus return sparse undefined jika server tidak mengirim sparse', async () => {
+        mockEmbedResponse([{ dense: [0.1], sparse: null }]);
+        const result = await embed({ texts: ['hello'], returnSparse: false });
+        expect(result.results[0]!.sparse).toBeUndefined();
+    });
+});
+
 // === Integration Tests ===
 
 const embedUp = await isEmbedReachable();
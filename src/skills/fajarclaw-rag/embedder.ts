@@ -115,7 +115,7 @@ export async function embed(options: EmbedOptions): Promise<EmbedResponse> {
     }
 
     const data = await response.json() as {
-        results: Array<{ dense: number[]; sparse?: Record<string, number> }>;
+        results: Array<{ dense: number[]; sparse?: { indices: number[]; values: number[] } }>;
         model: string;
         duration_ms: number;
     };
@@ -125,7 +125,7 @@ export async function embed(options: EmbedOptions): Promise<EmbedResponse> {
             dense: r.dense,
             sparse: r.sparse
                 ? Object.fromEntries(
-                    Object.entries(r.sparse).map(([k, v]) => [Number(k), v])
+                    r.sparse.indices.map((idx, i) => [idx, r.sparse!.values[i]])
                 )
                 : undefined,
         })),